@@ -0,0 +1,333 @@
+"""Benchmark harness for the recipe hot paths.
+
+Generates synthetic MSs (with sub-MSs) and synthetic LSMs of configurable size, times the
+recipe-level operations on them, and writes the results to a JSON file tagged with the current
+git commit, so that runs on different commits can be compared. Nothing here needs the real data.
+
+The recipe-level operations live in the recipe, so the recipe passes them in, see benchmark()
+in pyxis-RP3C147.py. Typical use:
+
+  pyxis benchmark
+  pyxis benchmark[sizes="small,medium",repeat=5]
+"""
+
+from Pyxis.ModSupport import *
+
+import os
+import os.path
+import glob
+import shutil
+import math
+import time
+import json
+import socket
+import subprocess
+import traceback
+
+import numpy
+import pyfits
+import pyrap.tables
+
+import lsm
+import gaussconv
+import polcube
+
+register_pyxis_module(superglobals="MS LSM");
+
+define('BENCH_DIR',"bench","directory for synthetic data and benchmark results")
+define('BENCH_OUTPUT_Template',"$BENCH_DIR/bench-%s.json"%time.strftime("%Y%m%d-%H%M%S"),"benchmark results file")
+define('BENCH_REPEAT',3,"number of times each operation is timed (the best time is also reported)")
+define('BENCH_SEED',42,"random seed for the synthetic data, so that runs on different commits use identical data")
+
+# Benchmark sizes. nant/ntime/nchan/nsub/nrows set up the synthetic MS (if nrows is given,
+# ntime is derived from it), nsrc/ngauss/nde the synthetic LSM, npix the synthetic model images.
+BENCH_SIZES = dict(
+  small  = dict(nant=7, ntime=60, nchan=16,nsub=2,nsrc=50,  ngauss=10, nde=5, npix=256),
+  medium = dict(nant=14,ntime=120,nchan=32,nsub=2,nsrc=200, ngauss=50, nde=10,npix=1024),
+  large  = dict(nant=27,ntime=240,nchan=64,nsub=4,nsrc=1000,ngauss=200,nde=20,npix=2048),
+);
+BENCH_SIZE_ORDER = [ "small","medium","large" ];
+
+DEG = math.pi/180
+ARCSEC = DEG/3600
+
+# 3C147 field centre, and VLA array centre (ITRF)
+RA0,DEC0 = 1.49488452602,0.870081702198
+VLA_XYZ = numpy.array([-1601185.4,-5041977.5,3554875.9])
+FREQ0 = 1.385e+9
+
+def make_ms (msname,nant=7,ntime=60,nchan=16,nrows=None,nfield=2,ncorr=4,dt=5,chunk=100000):
+  """Makes a synthetic MS with nant antennas, ntime timeslots (or as many as needed to get nrows rows)
+  and nchan channels, with DATA, MODEL_DATA and CORRECTED_DATA columns. Visibilities are random noise,
+  UVWs are simply antenna position differences, i.e. not physically meaningful (though at array scale),
+  but the table layout matches what the recipe expects. Returns the number of rows.""";
+  msname = interpolate_locals("msname");
+  nbl = nant*(nant-1)//2;
+  if nrows:
+    ntime = int(math.ceil(float(nrows)/nbl));
+  nrows = nbl*ntime;
+  info("making synthetic MS $msname: $nant antennas, $ntime timeslots, $nchan channels, $nrows rows");
+  if os.path.exists(msname):
+    shutil.rmtree(msname);
+  coldesc = [ pyrap.tables.makearrcoldesc(col,0j,shape=[nchan,ncorr],valuetype='complex')
+              for col in ("DATA","MODEL_DATA","CORRECTED_DATA") ];
+  tab = pyrap.tables.default_ms(msname,pyrap.tables.maketabdesc(coldesc));
+  # ANTENNA subtable: a random layout a few km across around the VLA. Positions of some antennas
+  # are mirrored in Y (the "VLA in India" problem fixed by fix_antpos())
+  anttab = pyrap.tables.table(msname+"/ANTENNA",readonly=False,ack=False);
+  anttab.addrows(nant);
+  pos = VLA_XYZ[numpy.newaxis,:] + numpy.random.uniform(-2000,2000,(nant,3));
+  # UVWs below come from the true positions, only the ANTENNA table gets the mirrored ones
+  antpos = pos.copy();
+  antpos[::3,1] = -antpos[::3,1];
+  anttab.putcol("POSITION",antpos);
+  anttab.putcol("NAME",[ "ea%02d"%i for i in range(nant) ]);
+  anttab.putcol("STATION",[ "VLA:N%d"%i for i in range(nant) ]);
+  anttab.putcol("DISH_DIAMETER",numpy.full(nant,25.));
+  anttab.close();
+  # SPECTRAL_WINDOW, POLARIZATION and DATA_DESCRIPTION subtables
+  width = 2e+6;
+  spwtab = pyrap.tables.table(msname+"/SPECTRAL_WINDOW",readonly=False,ack=False);
+  spwtab.addrows(1);
+  spwtab.putcol("CHAN_FREQ",(FREQ0+numpy.arange(nchan)*width)[numpy.newaxis,:]);
+  for col in "CHAN_WIDTH","EFFECTIVE_BW","RESOLUTION":
+    spwtab.putcol(col,numpy.full((1,nchan),width));
+  spwtab.putcol("NUM_CHAN",[nchan]);
+  spwtab.putcol("REF_FREQUENCY",[FREQ0]);
+  spwtab.putcol("TOTAL_BANDWIDTH",[nchan*width]);
+  spwtab.close();
+  poltab = pyrap.tables.table(msname+"/POLARIZATION",readonly=False,ack=False);
+  poltab.addrows(1);
+  poltab.putcol("NUM_CORR",[ncorr]);
+  poltab.putcol("CORR_TYPE",numpy.array([[5,6,7,8][:ncorr]]));
+  poltab.putcol("CORR_PRODUCT",numpy.array([[[0,0],[0,1],[1,0],[1,1]][:ncorr]]));
+  poltab.close();
+  ddtab = pyrap.tables.table(msname+"/DATA_DESCRIPTION",readonly=False,ack=False);
+  ddtab.addrows(1);
+  ddtab.putcol("SPECTRAL_WINDOW_ID",[0]);
+  ddtab.putcol("POLARIZATION_ID",[0]);
+  ddtab.close();
+  # FIELD subtable: the recipe's swapfields() wants at least two
+  fieldtab = pyrap.tables.table(msname+"/FIELD",readonly=False,ack=False);
+  fieldtab.addrows(nfield);
+  dirs = numpy.array([ [[RA0+i*DEG,DEC0]] for i in range(nfield) ]);
+  for col in "PHASE_DIR","DELAY_DIR","REFERENCE_DIR":
+    fieldtab.putcol(col,dirs);
+  fieldtab.putcol("NAME",[ "FIELD%d"%i for i in range(nfield) ]);
+  fieldtab.close();
+  # main table, filled in chunks of rows to keep memory bounded
+  a1,a2 = numpy.triu_indices(nant,1);
+  t0 = 4.9e+9;
+  tab.addrows(nrows);
+  for row0 in range(0,nrows,chunk):
+    nr = min(chunk,nrows-row0);
+    rows = numpy.arange(row0,row0+nr);
+    ibl,itime = rows%nbl,rows//nbl;
+    tab.putcol("ANTENNA1",a1[ibl],row0,nr);
+    tab.putcol("ANTENNA2",a2[ibl],row0,nr);
+    tab.putcol("UVW",pos[a2[ibl]]-pos[a1[ibl]],row0,nr);
+    tab.putcol("TIME",t0+itime*dt,row0,nr);
+    tab.putcol("TIME_CENTROID",t0+itime*dt,row0,nr);
+    for col in "EXPOSURE","INTERVAL":
+      tab.putcol(col,numpy.full(nr,float(dt)),row0,nr);
+    # alternate timeslots between fields 0 and 1
+    tab.putcol("FIELD_ID",(itime%min(nfield,2)).astype(int),row0,nr);
+    tab.putcol("DATA_DESC_ID",numpy.zeros(nr,int),row0,nr);
+    tab.putcol("FLAG",numpy.zeros((nr,nchan,ncorr),bool),row0,nr);
+    tab.putcol("WEIGHT",numpy.ones((nr,ncorr),numpy.float32),row0,nr);
+    tab.putcol("SIGMA",numpy.ones((nr,ncorr),numpy.float32),row0,nr);
+    vis = (numpy.random.normal(size=(nr,nchan,ncorr))+1j*numpy.random.normal(size=(nr,nchan,ncorr))).astype(numpy.complex64);
+    for col in "DATA","MODEL_DATA","CORRECTED_DATA":
+      tab.putcol(col,vis,row0,nr);
+  tab.close();
+  return nrows;
+
+def make_multims (msname,nsub=2,nant=7,ntime=60,nrows=None,**kw):
+  """Makes a synthetic MS as per make_ms(), plus nsub sub-MSs of ntime/nsub timeslots
+  (or nrows/nsub rows) each under msname/SUBMSS, as expected by jointcal(). Timeslots are
+  rounded so that the main MS has exactly as many rows as all the sub-MSs together.""";
+  msname = interpolate_locals("msname");
+  nbl = nant*(nant-1)//2;
+  if nrows:
+    subtime = int(math.ceil(float(nrows)/(nsub*nbl)));
+  else:
+    subtime = max(ntime//nsub,1);
+  nrows = make_ms(msname,nant=nant,ntime=subtime*nsub,**kw);
+  subdir = os.path.join(msname,"SUBMSS");
+  if not os.path.exists(subdir):
+    os.mkdir(subdir);
+  basename = os.path.splitext(os.path.basename(msname))[0];
+  for i in range(nsub):
+    make_ms(os.path.join(subdir,"%s-%d.MS"%(basename,i)),nant=nant,ntime=subtime,**kw);
+  return nrows;
+
+def make_lsm (filename,nsrc=100,ngauss=10,nde=5,radius=.5*DEG,dE="dE"):
+  """Makes a synthetic LSM with nsrc sources scattered within 'radius' of the 3C147 field centre,
+  ngauss of which are Gaussians. The nde brightest sources get a 'dE' tag. Fluxes, polarization,
+  rotation measures and spectral indices are random.""";
+  from Tigger.Models import ModelClasses,SkyModel
+  filename = interpolate_locals("filename");
+  r = radius*numpy.sqrt(numpy.random.uniform(0,1,nsrc));
+  theta = numpy.random.uniform(0,2*math.pi,nsrc);
+  ra = RA0 + r*numpy.sin(theta)/math.cos(DEC0);
+  dec = DEC0 + r*numpy.cos(theta);
+  iflux = numpy.sort(numpy.random.pareto(1.5,nsrc)*1e-3)[::-1];
+  pf,pa = numpy.random.uniform(0,.1,nsrc),numpy.random.uniform(0,math.pi,nsrc);
+  sources = [];
+  for i in range(nsrc):
+    flux = ModelClasses.PolarizationWithRM(iflux[i],iflux[i]*pf[i]*math.cos(2*pa[i]),iflux[i]*pf[i]*math.sin(2*pa[i]),0.,
+                                           numpy.random.uniform(-50,50),FREQ0);
+    spectrum = ModelClasses.SpectralIndex(numpy.random.uniform(-1,0),FREQ0);
+    shape = None;
+    if i >= nsrc-ngauss:
+      ex = numpy.random.uniform(2,20)*ARCSEC;
+      shape = ModelClasses.Gaussian(ex,ex*numpy.random.uniform(.3,1),numpy.random.uniform(0,math.pi));
+    src = ModelClasses.Source("S%d"%i,ModelClasses.Position(ra[i],dec[i]),flux,spectrum=spectrum,shape=shape);
+    if i < nde:
+      src.setAttribute(dE,True);
+    sources.append(src);
+  model = SkyModel.SkyModel(*sources);
+  model.save(filename);
+
+def make_image (filename,npix=1024,nchan=1,nstokes=1):
+  """Makes a synthetic FITS model image (sparse random clean components) of npix x npix pixels.
+  The data is written one plane at a time via polcube.create_fits() and memmap.""";
+  filename = interpolate_locals("filename");
+  hdr = pyfits.Header();
+  hdr['SIMPLE'] = True;
+  hdr['BITPIX'] = -32;
+  hdr['NAXIS'] = 4;
+  axes = [ (npix,"RA---SIN",RA0/DEG,-2*ARCSEC/DEG),(npix,"DEC--SIN",DEC0/DEG,2*ARCSEC/DEG),
+           (nchan,"FREQ",FREQ0,2e+6),(nstokes,"STOKES",1,1) ];
+  # FITS wants all the NAXISn cards straight after NAXIS, before any other per-axis cards
+  for i,(n,ctype,crval,cdelt) in enumerate(axes):
+    hdr['NAXIS%d'%(i+1)] = n;
+  for i,(n,ctype,crval,cdelt) in enumerate(axes):
+    hdr['CTYPE%d'%(i+1)] = ctype;
+    hdr['CRVAL%d'%(i+1)] = crval;
+    hdr['CDELT%d'%(i+1)] = cdelt;
+    hdr['CRPIX%d'%(i+1)] = npix/2+1 if i<2 else 1;
+  polcube.create_fits(filename,hdr,numpy.float32);
+  ff = pyfits.open(filename,mode='update',memmap=True);
+  data = ff[0].data;
+  ncc = max(npix*npix//1000,1);
+  for ist in range(nstokes):
+    for ichan in range(nchan):
+      plane = numpy.zeros((npix,npix),numpy.float32);
+      plane[numpy.random.randint(0,npix,ncc),numpy.random.randint(0,npix,ncc)] = numpy.random.uniform(0,1e-3,ncc);
+      data[ist,ichan] = plane;
+  ff.flush();
+  ff.close();
+
+def _git_commit ():
+  """Returns the current git commit of the recipe directory, or None""";
+  try:
+    return subprocess.check_output(["git","rev-parse","HEAD"],
+              cwd=os.path.dirname(os.path.abspath(__file__))).strip().decode();
+  except Exception:
+    return None;
+
+def time_op (func,repeat=None,setup=None):
+  """Times func() 'repeat' times, calling setup() (untimed) before each run.
+  Returns a dict of timings, or of the error if the operation failed.""";
+  repeat = repeat or BENCH_REPEAT;
+  times = [];
+  try:
+    for i in range(repeat):
+      if setup:
+        setup();
+      t0 = time.time();
+      func();
+      times.append(time.time()-t0);
+  except (Exception,SystemExit) as exc:
+    # operations that need external tools (turbo-sim, lwimager) fail where those are not installed:
+    # record the failure and carry on with the rest
+    warn("benchmark operation failed: %s"%exc);
+    return dict(error=str(exc),traceback=traceback.format_exc(),times=times);
+  return dict(times=times,best=min(times),mean=sum(times)/len(times));
+
+def run (ops,sizes=None,repeat=None,output="$BENCH_OUTPUT",keep=False):
+  """Runs benchmarks. 'ops' is a list of (name,setup) tuples, where setup(data) is called once
+  per size with a dict describing the synthetic data (filenames and size parameters), and returns
+  the function to be timed, or a (func,presetup) tuple, where presetup() is called (untimed) before
+  every timed run. 'sizes' is a list (or comma-separated string) of BENCH_SIZES keys.
+  Results are written to 'output' as JSON, and also returned.""";
+  output = interpolate_locals("output");
+  sizes = sizes or BENCH_SIZE_ORDER;
+  if isinstance(sizes,str):
+    sizes = sizes.split(",");
+  if not os.path.exists(BENCH_DIR):
+    os.makedirs(BENCH_DIR);
+  results = dict(commit=_git_commit(),host=socket.gethostname(),seed=BENCH_SEED,
+                 timestamp=time.strftime("%Y-%m-%d %H:%M:%S"),repeat=repeat or BENCH_REPEAT,
+                 sizes=dict([ (size,BENCH_SIZES[size]) for size in sizes ]),results=[]);
+  saved_ms,saved_lsm = MS,LSM;
+  try:
+    for size in sizes:
+      params = BENCH_SIZES[size];
+      info("########## benchmark size $size: $params");
+      # make synthetic data for this size
+      base = os.path.join(BENCH_DIR,"synth-%s"%size);
+      data = dict(params,size=size,ms=base+".MS",lsm=base+".lsm.html",lsm2=base+"-2.lsm.html",
+                  lsmout=base+"-out.lsm.html",image=base+".model.fits",imageout=base+"-out.fits",base=base);
+      t0 = time.time();
+      numpy.random.seed(BENCH_SEED);
+      msparams = dict([ (key,params[key]) for key in ("nant","ntime","nchan","nsub","nrows") if key in params ]);
+      data['nrows'] = make_multims(data['ms'],**msparams);
+      make_lsm(data['lsm'],nsrc=params['nsrc'],ngauss=params['ngauss'],nde=params['nde']);
+      make_lsm(data['lsm2'],nsrc=params['nsrc'],ngauss=params['ngauss'],nde=0);
+      make_image(data['image'],npix=params['npix']);
+      info("synthetic data made in %.2fs"%(time.time()-t0));
+      v.MS = data['ms'];
+      v.LSM = data['lsm'];
+      for name,setup in ops:
+        info("timing $name ($size)");
+        func,presetup = setup(data),None;
+        if isinstance(func,tuple):
+          func,presetup = func;
+        res = time_op(func,repeat=repeat,setup=presetup);
+        res.update(op=name,size=size);
+        if 'best' in res:
+          info(">>> $name ($size): best %.3fs, mean %.3fs"%(res['best'],res['mean']));
+        results['results'].append(res);
+      if not keep:
+        for path in glob.glob(base+"*"):
+          if os.path.isdir(path):
+            shutil.rmtree(path);
+          else:
+            os.remove(path);
+  finally:
+    v.MS,v.LSM = saved_ms,saved_lsm;
+  json.dump(results,open(output,"w"),indent=2,sort_keys=True);
+  info("benchmark results written to $output");
+  return results;
+
+## standard set of operations that are not recipe-specific: LSM handling, and the local gaussconv and
+## polcube modules. The recipe adds its own on top of this, see benchmark() in pyxis-RP3C147.py
+
+def _lsm_load (data):
+  import Tigger
+  return lambda:Tigger.load(data['lsm']);
+
+def _lsm_merge (data):
+  return lambda:lsm.tigger_convert("%s -a %s %s --rename -f"%(data['lsm'],data['lsm2'],data['lsmout']));
+
+def _lsm_transfer_tags (data):
+  # transfer_tags() modifies the target LSM in place, so restore a clean copy first (untimed)
+  func = lambda:lsm.transfer_tags(data['lsm'],data['lsmout'],tags="dE",tolerance=45*ARCSEC);
+  presetup = lambda:shutil.copy(data['lsm2'],data['lsmout']);
+  return func,presetup;
+
+def _lsm_convolve (data):
+  return lambda:gaussconv.convolve_lsm(data['lsm'],data['lsmout'],beam=(10*ARCSEC,5*ARCSEC,30*DEG));
+
+def _polcube (data):
+  return lambda:polcube.make_polcube(data['image'],data['imageout'],pf=.1,pa=33,rm=10,spi=-.7);
+
+STANDARD_OPS = [
+  ("lsm_load",_lsm_load),
+  ("lsm_merge",_lsm_merge),
+  ("lsm_transfer_tags",_lsm_transfer_tags),
+  ("lsm_convolve",_lsm_convolve),
+  ("polcube",_polcube),
+];
@@ -0,0 +1,140 @@
+"""Vectorized convolution and deconvolution of Gaussian source shapes.
+
+This is the array version of convolveGaussian() from the "Convolving gaussian sources" notebook.
+Shapes are given as FWHM extents (ex,ey) and a position angle pa of the ex axis, measured
+North through East, all in radians, as in Tigger's Gaussian shapes. Any of the arguments may
+be scalars or arrays, and are broadcast against each other, so one beam can be applied to N
+sources, or each source can come with its own beam.
+
+Rather than going through the Fourier plane, each Gaussian is represented by its second-moment
+(covariance) matrix, in units of FWHM^2. Under convolution these matrices simply add, and under
+deconvolution they subtract, so the whole thing is a few NumPy expressions for any number of sources.
+"""
+
+from Pyxis.ModSupport import *
+
+import numpy
+import math
+
+import Tigger
+from Tigger.Models.ModelClasses import Gaussian
+
+import imager
+
+register_pyxis_module(superglobals="LSM");
+
+DEG = math.pi/180
+
+define('GAUSSCONV_TOLERANCE',1e-6,"""relative tolerance below which deconvolved extents are treated
+  as unresolved (i.e. set to 0)""")
+
+def shape_to_moments (ex,ey,pa):
+  """Converts Gaussian extents ex,ey and position angle pa into the second-moment matrix
+  components (xx,yy,xy), with x pointing East and y North. Returns arrays.""";
+  ex,ey,pa = numpy.broadcast_arrays(*[ numpy.asarray(a,float) for a in (ex,ey,pa) ]);
+  s,c = numpy.sin(pa),numpy.cos(pa);
+  ex2,ey2 = ex**2,ey**2;
+  xx = ex2*s**2 + ey2*c**2;
+  yy = ex2*c**2 + ey2*s**2;
+  xy = (ex2-ey2)*s*c;
+  return xx,yy,xy;
+
+def moments_to_shape (xx,yy,xy,tolerance=None,scale=None):
+  """Converts second-moment matrix components back into Gaussian extents and position angle.
+  Returns ex,ey,pa arrays, with ex being the major axis and pa in [0,pi).
+  Negative eigenvalues (which deconvolution produces for sources smaller than the beam) are
+  clipped to 0, as are eigenvalues below 'tolerance' times 'scale' (default is the trace).
+  Circular shapes get pa=0.""";
+  tolerance = GAUSSCONV_TOLERANCE if tolerance is None else tolerance;
+  xx,yy,xy = numpy.broadcast_arrays(*[ numpy.asarray(a,float) for a in (xx,yy,xy) ]);
+  trace = xx+yy;
+  diff = numpy.sqrt((xx-yy)**2+4*xy**2);
+  lmaj = (trace+diff)/2;
+  lmin = (trace-diff)/2;
+  # clip negative and vanishingly small eigenvalues
+  thresh = tolerance*numpy.abs(trace if scale is None else scale);
+  lmaj = numpy.where(lmaj>thresh,lmaj,0);
+  lmin = numpy.where(lmin>thresh,lmin,0);
+  ex = numpy.sqrt(lmaj);
+  ey = numpy.sqrt(lmin);
+  # the major axis direction. Circular shapes and point sources get pa=0, including those that are
+  # only circular to within numerical noise, so that they do not end up with random angles
+  small = (diff <= thresh) | (lmaj == 0);
+  pa = numpy.where(small,0,.5*numpy.arctan2(2*xy,yy-xx))%math.pi;
+  # a tiny negative angle modulo pi comes out as exactly pi, so wrap that back to 0
+  pa = numpy.where(pa>=math.pi,0,pa);
+  return numpy.asarray(ex),numpy.asarray(ey),numpy.asarray(pa);
+
+def convolve_gaussians (ex,ey,pa,bmaj,bmin,bpa):
+  """Convolves Gaussians (ex,ey,pa) with beams (bmaj,bmin,bpa). Arguments are broadcast
+  against each other. Returns new ex,ey,pa arrays.""";
+  sxx,syy,sxy = shape_to_moments(ex,ey,pa);
+  bxx,byy,bxy = shape_to_moments(bmaj,bmin,bpa);
+  # convolution never makes anything smaller, so there is nothing to treat as unresolved
+  return moments_to_shape(sxx+bxx,syy+byy,sxy+bxy,tolerance=0);
+
+def deconvolve_gaussians (ex,ey,pa,bmaj,bmin,bpa,tolerance=None):
+  """Deconvolves beams (bmaj,bmin,bpa) from Gaussians (ex,ey,pa). Arguments are broadcast
+  against each other. Returns new ex,ey,pa arrays. Axes along which a source is not resolved
+  come back as 0, so a source no bigger than the beam becomes ex=ey=0, i.e. a point source.""";
+  sxx,syy,sxy = shape_to_moments(ex,ey,pa);
+  bxx,byy,bxy = shape_to_moments(bmaj,bmin,bpa);
+  # judge what is unresolved relative to the size of the original source, not of the difference
+  return moments_to_shape(sxx-bxx,syy-byy,sxy-bxy,tolerance=tolerance,scale=sxx+syy);
+
+def beam_from_fits (filename="${imager.RESTORED_IMAGE}"):
+  """Reads the restoring beam (BMAJ,BMIN,BPA) from the header of a FITS image.
+  Returns bmaj,bmin,bpa in radians.""";
+  import pyfits
+  filename = interpolate_locals("filename");
+  hdr = pyfits.open(filename)[0].header;
+  try:
+    return hdr['BMAJ']*DEG,hdr['BMIN']*DEG,hdr['BPA']*DEG;
+  except KeyError:
+    abort("$filename does not contain a restoring beam (BMAJ/BMIN/BPA)");
+
+def convolve_lsm (lsm="$LSM",output=None,beam=None,deconvolve=False,points=True):
+  """Convolves the shapes of all sources in an LSM with a beam, or deconvolves the beam from them.
+  'beam' is a bmaj,bmin,bpa tuple in radians (each element may also be an array with a value per source,
+  in the order of model.sources), or a FITS filename from which the restoring beam is read.
+  If 'points' is True, point sources are convolved too (and become Gaussians), else only Gaussians are
+  changed. When deconvolving, sources that end up unresolved along both axes become point sources.
+  The result is written to 'output', or back to 'lsm' if output is not given.""";
+  lsm = interpolate_locals("lsm");
+  output = II(output) if output else lsm;
+  if beam is None:
+    abort("convolve_lsm(): a beam must be specified");
+  if isinstance(beam,str):
+    beam = beam_from_fits(beam);
+  model = Tigger.load(lsm);
+  sources = model.sources;
+  # pick out the sources that are to be changed, and collect their shapes into arrays in one pass
+  shapes = [ src.shape if isinstance(getattr(src,'shape',None),Gaussian) else None for src in sources ];
+  if deconvolve or not points:
+    select = [ i for i,shape in enumerate(shapes) if shape is not None ];
+  else:
+    select = range(len(sources));
+  if not select:
+    info("$lsm contains no sources to be processed");
+    return;
+  select = numpy.array(select,int);
+  shape0 = numpy.zeros((len(sources),3),float);
+  for i in select:
+    if shapes[i] is not None:
+      shape0[i] = shapes[i].ex,shapes[i].ey,shapes[i].pa;
+  # a per-source beam comes in for all sources, so select the same subset from it
+  beam = [ numpy.asarray(b,float) for b in beam ];
+  beam = [ b[select] if b.ndim else b for b in beam ];
+  func = deconvolve_gaussians if deconvolve else convolve_gaussians;
+  ex,ey,pa = func(shape0[select,0],shape0[select,1],shape0[select,2],*beam);
+  npoint = 0;
+  for i,x,y,p in zip(select,ex,ey,pa):
+    if x > 0:
+      sources[i].shape = Gaussian(float(x),float(y),float(p));
+    else:
+      sources[i].shape = None;
+      npoint += 1;
+  info("%s %d source shapes in $lsm, writing $output"%("deconvolved" if deconvolve else "convolved",len(select)));
+  if npoint:
+    info("%d sources are unresolved and have been made into point sources"%npoint);
+  model.save(output);
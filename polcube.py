@@ -0,0 +1,118 @@
+"""Builds polarized (IQUV) model cubes from total-intensity model images.
+
+This is the streaming version of what the "3C286 models" notebook does to make 3C286_X.pol.fits.
+Instead of allocating the full 4-Stokes cube in memory, the output FITS file is created at its
+final size on disk, memory-mapped, and filled in one image plane at a time, so peak memory
+stays at about one plane regardless of the cube size.
+
+The polarization model follows the PolarizationWithRM and SpectralIndex fields of the LSMs:
+  I(nu) = I*(nu/freq0)**spi
+  Q(nu) = pf*I(nu)*cos(2*chi), U(nu) = pf*I(nu)*sin(2*chi), V(nu) = vf*I(nu)
+  chi = pa + rm*(lambda**2-lambda0**2)
+i.e. pa is the polarization angle at freq0.
+"""
+
+from Pyxis.ModSupport import *
+
+import numpy
+import math
+import os.path
+
+import pyfits
+
+import imager
+
+register_pyxis_module();
+
+# speed of light, m/s
+C = 299792458.
+
+def _find_axis (hdr,ctype):
+  """Returns the FITS axis number (1-based) whose CTYPE starts with 'ctype', or None""";
+  for i in range(1,hdr['NAXIS']+1):
+    if hdr.get('CTYPE%d'%i,'').upper().startswith(ctype):
+      return i;
+  return None;
+
+def _axis_values (hdr,iaxis):
+  """Returns an array of world coordinates along the given FITS axis""";
+  n = hdr['NAXIS%d'%iaxis];
+  return hdr['CRVAL%d'%iaxis] + (numpy.arange(n)+1-hdr['CRPIX%d'%iaxis])*hdr['CDELT%d'%iaxis];
+
+def create_fits (filename,hdr,dtype):
+  """Creates a FITS file with the given header and an empty data section of the full size,
+  without ever holding the data in memory. The data can then be filled in via memmap.""";
+  shape = [ hdr['NAXIS%d'%i] for i in range(hdr['NAXIS'],0,-1) ];
+  nbytes = int(numpy.prod(shape))*numpy.dtype(dtype).itemsize;
+  # FITS data sections are padded out to a multiple of 2880 bytes
+  nbytes = ((nbytes+2879)//2880)*2880;
+  hdr.tofile(filename,clobber=True);
+  fobj = open(filename,'rb+');
+  fobj.seek(len(hdr.tostring())+nbytes-1);
+  fobj.write(b'\0');
+  fobj.close();
+
+def make_polcube (image="${imager.MODEL_IMAGE}",output=None,pf=0,pa=0,rm=0,spi=0,freq0=None,vf=0,scale=1):
+  """Makes an IQUV model cube out of a total-intensity model image.
+  'pf' is the linear polarization fraction, 'pa' the polarization angle (in degrees) at freq0,
+  'rm' the rotation measure (rad/m^2), 'spi' the spectral index, 'vf' the circular polarization fraction.
+  'freq0' defaults to the reference frequency of the image. 'scale' is applied to all planes.
+  The first Stokes plane of the input is taken to be I. The output is written plane by plane
+  through a memory-mapped file, to 'output', or to image.pol.fits if not given.""";
+  image = interpolate_locals("image");
+  output = II(output) if output else os.path.splitext(image)[0]+".pol.fits";
+  # BSCALE/BZERO are applied per plane below, as letting pyfits do it would load the whole image
+  ff = pyfits.open(image,memmap=True,do_not_scale_image_data=True);
+  hdr = ff[0].header;
+  bscale,bzero = hdr.get('BSCALE',1),hdr.get('BZERO',0);
+  naxis = hdr['NAXIS'];
+  istokes = _find_axis(hdr,"STOKES");
+  ifreq = _find_axis(hdr,"FREQ");
+  if istokes is None:
+    abort("$image does not have a STOKES axis");
+  # per-channel frequencies, and the corresponding I and Q/U scalings
+  if ifreq is not None:
+    freqs = _axis_values(hdr,ifreq);
+    freq0 = freq0 or hdr['CRVAL%d'%ifreq];
+  elif rm or spi:
+    abort("$image does not have a FREQ axis, can't apply a rotation measure or spectral index");
+  else:
+    freqs = numpy.array([0.]);
+  ifactor = scale*(freqs/freq0)**spi if spi else numpy.ones_like(freqs)*scale;
+  chi = pa*math.pi/180 + (rm*((C/freqs)**2-(C/freq0)**2) if rm else 0);
+  qfactor = ifactor*pf*numpy.cos(2*chi);
+  ufactor = ifactor*pf*numpy.sin(2*chi);
+  vfactor = ifactor*vf;
+  info("making IQUV cube $output from $image: pf=$pf pa=$pa deg rm=$rm spi=$spi, %d channel(s)"%len(freqs));
+  # output header is the input header with a 4-element Stokes axis, and float32 data
+  outhdr = hdr.copy();
+  outhdr['BITPIX'] = -32;
+  outhdr['NAXIS%d'%istokes] = 4;
+  outhdr['CRVAL%d'%istokes] = 1;
+  outhdr['CDELT%d'%istokes] = 1;
+  outhdr['CRPIX%d'%istokes] = 1;
+  for key in 'BSCALE','BZERO':
+    if key in outhdr:
+      del outhdr[key];
+  create_fits(output,outhdr,numpy.float32);
+  out = pyfits.open(output,mode='update',memmap=True);
+  indata,outdata = ff[0].data,out[0].data;
+  # numpy axis indices corresponding to the FITS stokes and freq axes
+  sax = naxis-istokes;
+  fax = naxis-ifreq if ifreq is not None else None;
+  index = [ slice(None) ]*naxis;
+  for ichan in range(len(freqs)):
+    if fax is not None:
+      index[fax] = ichan;
+    index[sax] = 0;
+    iplane = indata[tuple(index)].astype(numpy.float32);
+    if bscale != 1 or bzero != 0:
+      iplane = iplane*bscale + bzero;
+    # the file starts out zero-filled, so planes with a zero factor can be skipped
+    for ist,factor in enumerate((ifactor,qfactor,ufactor,vfactor)):
+      if factor[ichan]:
+        index[sax] = ist;
+        outdata[tuple(index)] = iplane*factor[ichan];
+  out.flush();
+  out.close();
+  ff.close();
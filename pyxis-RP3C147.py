@@ -9,6 +9,13 @@ import Pyxis
 # Note that Pyxides is implicitly added to the include path, so no need to specify it at import
 import mqt,stefcal,imager,lsm,std,ms
 
+# local module for bulk (de)convolution of Gaussian source shapes, e.g. "pyxis gaussconv.convolve_lsm[...]"
+import gaussconv
+# local module for streaming IQUV model cubes for --add-brick, e.g. "pyxis polcube.make_polcube[...]"
+import polcube
+# local module for benchmarking on synthetic data, see benchmark() below
+import bench
+
 # we use this below
 import pyfits
 import numpy
@@ -179,11 +186,7 @@ def runcal (goto_step=1):
     
     info("########## adding clean components to LSM");
     CCMODEL = II("ccmodel-ddid${ms.DDID}.fits");  # note the per-style variable interpolation done by the II() function
-    ff = pyfits.open(imager.MODEL_IMAGE);
-    dd = ff[0].data;
-    dd *= 1.0769     # scale up to compensate for selfcal flux suppression
-    # dd[dd<0] = 0;  # remove negative components
-    ff.writeto(CCMODEL,clobber=True);
+    scale_ccmodel(imager.MODEL_IMAGE,CCMODEL);
     # add model image to LSM
     lsm.tigger_convert("$LSM $LSM2 --add-brick=ccmodel:$CCMODEL:2 -f");
 
@@ -241,11 +244,7 @@ def c_cal (goto_step=1):
       restore=dict(npix=NPIX,threshold=CLEAN_THRESH[1]));
     
     info("########## adding clean components to LSM");
-    ff = pyfits.open(imager.MODEL_IMAGE);
-    dd = ff[0].data;
-    dd *= 1.0769     # scale up to compensate for selfcal flux suppression
-    # dd[dd<0] = 0;  # remove negative components
-    ff.writeto(LSM_CCMODEL,clobber=True);
+    scale_ccmodel(imager.MODEL_IMAGE,LSM_CCMODEL);
     # add model image to LSM
     lsm.tigger_convert("$LSM $LSM2 --add-brick=ccmodel:$LSM_CCMODEL:2 -f");
 
@@ -389,11 +388,7 @@ def jointcal (goto_step=1,last_step=10,lsmbase=None,STEPS=None):
     v.MS = FULLMS
     imager.make_image(dirty=False,stokes="IV",restore=dict(npix=NPIX,threshold=CLEAN_THRESH[1],wprojplanes=128),restore_lsm=False);
     info("########## adding clean components to LSM");
-    ff = pyfits.open(imager.MODEL_IMAGE);
-    dd = ff[0].data;
-    dd *= 1.0769     # scale up to compensate for selfcal flux suppression
-    # dd[dd<0] = 0;  # remove negative components
-    ff.writeto(LSM_CCMODEL,clobber=True);
+    scale_ccmodel(imager.MODEL_IMAGE,LSM_CCMODEL);
     # add model image to LSM
     lsm.tigger_convert("$LSM $LSM3 --add-brick=ccmodel:$LSM_CCMODEL:2 -f");
 
@@ -438,8 +433,19 @@ def jointcal_de_final ():
                   diffgains=True,dirty=dict(wprojplanes=0,npix=NPIX),restore=False); 
                   # ,options=dict(stefcal_diagonal_ifr_gains='full'))  
 
-def makecube (npix=512,stokes="I"):
-  imager.make_image(channelize=1,dirty_image="$OUTFILE.cube.fits",npix=npix,wprojplanes=0,stokes=stokes);
+CCMODEL_SCALE = 1.0769     # scale up to compensate for selfcal flux suppression
+
+def scale_ccmodel (model,output,scale=None):
+  """Scales the clean component model image by CCMODEL_SCALE (or 'scale'), and writes it to 'output'""";
+  ff = pyfits.open(model);
+  dd = ff[0].data;
+  dd *= scale or CCMODEL_SCALE;
+  # dd[dd<0] = 0;  # remove negative components
+  ff.writeto(output,clobber=True);
+
+def makecube (npix=512,stokes="I",cube="$OUTFILE.cube.fits"):
+  cube = II(cube);
+  imager.make_image(channelize=1,dirty_image=cube,npix=npix,wprojplanes=0,stokes=stokes);
   
 def swapfields (f1,f2):
   """Swaps two fields in an MS"""
@@ -506,6 +512,39 @@ def addnoise (noise=0,rowchunk=100000):
   args = [ """${ms.MS_TDL} ${ms.CHAN_TDL} ms_sel.ms_ifr_subset_str=${ms.IFRS} noise_stddev=%g"""%noise ];
   mqt.run("${mqt.CATTERY}/Siamese/turbo-sim.py","simulate",section="addnoise",args=args);
 
+def benchmark (sizes=None,ops=None,repeat=None,keep=False):
+  """Times the recipe hot paths on synthetic MSs and LSMs, see bench.py. 'sizes' and 'ops' may be
+  given as comma-separated strings to select a subset. Results go to ${bench.BENCH_OUTPUT}""";
+  def _fix_antpos_setup (data):
+    # put every third antenna in India before each run, whatever state the previous run left them in
+    def mirror():
+      anttab = ms.msw(subtable="ANTENNA");
+      pos = anttab.getcol("POSITION");
+      pos[::3,1] = abs(pos[::3,1]);
+      anttab.putcol("POSITION",pos);
+      anttab.close();
+    return fix_antpos,mirror
+  recipe_ops = [
+    ("compute_vis_noise",lambda data:compute_vis_noise),
+    ("addnoise",lambda data:addnoise),
+    ("swapfields",lambda data:lambda:swapfields(0,1)),
+    ("fix_antpos",_fix_antpos_setup),
+    ("ccmodel_scale",lambda data:lambda:scale_ccmodel(data['image'],data['imageout'])),
+    ("makecube",lambda data:lambda:makecube(npix=data['npix'],cube=data['base']+".cube.fits")),
+  ];
+  allops = bench.STANDARD_OPS + recipe_ops;
+  if ops:
+    if isinstance(ops,str):
+      ops = ops.split(",");
+    allops = [ op for op in allops if op[0] in ops ];
+  # the synthetic MSs have a single SPW, and alternate between FIELDs 0 and 1
+  ddid,field = ms.DDID,ms.FIELD
+  ms.DDID,ms.FIELD = 0,0
+  try:
+    bench.run(allops,sizes=sizes,repeat=repeat,keep=keep);
+  finally:
+    ms.DDID,ms.FIELD = ddid,field
+
 import gce
 
 VMTYPE = 'n1-highmem-16';